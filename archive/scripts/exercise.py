@@ -1,8 +1,11 @@
 import httpx
 import sys
+import atexit
 import re
+import functools
 from collections import Counter
-from rich.console import Console
+from concurrent.futures import ThreadPoolExecutor
+from rich.console import Console, Group
 from rich.table import Table
 from rich.panel import Panel
 from rich.text import Text
@@ -10,16 +13,31 @@ from rich.prompt import Prompt
 
 # --- CONFIGURATION ---
 BASE_URL = "http://localhost:8000"
-EXERCISES_URL = f"{BASE_URL}/exercises"
-RESULTS_URL = f"{BASE_URL}/results"
+EXERCISES_PATH = "/exercises"
+RESULTS_PATH = "/results"
 
 WORD_BANK_INTERVAL = 5  # Show word bank every N questions
 
 console = Console(color_system='truecolor')
 
+# One keep-alive client for all API calls
+_client = httpx.Client(
+    base_url=BASE_URL,
+    timeout=30.0,
+    limits=httpx.Limits(max_keepalive_connections=4, max_connections=8),
+)
+atexit.register(_client.close)
+
+_PUNCT_RE = re.compile(r'[^\w\s]')
+
+@functools.lru_cache(maxsize=512)
+def _word_re(word):
+    """Case-insensitive pattern matching `word` literally, cached per word."""
+    return re.compile(re.escape(word), re.IGNORECASE)
+
 def get_latest_exercises():
     try:
-        response = httpx.get(EXERCISES_URL)
+        response = _client.get(EXERCISES_PATH)
         response.raise_for_status()
         data = response.json()
 
@@ -38,7 +56,7 @@ def submit_results(results_vector):
     console.print("\n[dim]Submitting results to server...[/dim]")
     try:
         payload = {"results": results_vector}
-        response = httpx.post(RESULTS_URL, json=payload)
+        response = _client.post(RESULTS_PATH, json=payload)
         if response.status_code in [200, 201]:
             console.print("[bold green]Results saved successfully![/bold green]")
         else:
@@ -48,35 +66,35 @@ def submit_results(results_vector):
 
 def normalize(text):
     """Strip punctuation and lowercase for comparison."""
-    return re.sub(r'[^\w\s]', '', text).lower().strip()
+    return _PUNCT_RE.sub('', text).lower().strip()
 
 def mask_sentence(sentence, word):
-    pattern = re.compile(re.escape(word), re.IGNORECASE)
-    return pattern.sub("___", sentence)
+    return _word_re(word).sub("___", sentence)
 
 def format_correction(sentence, target_word, user_word):
     """
     Replaces the target word in the sentence with: ~~user_word~~ **target_word**
     """
-    pattern = re.compile(re.escape(target_word), re.IGNORECASE)
+    pattern = _word_re(target_word)
     user_display = user_word if user_word else "___"
     replacement = f"[strike red]{user_display}[/strike red] [bold green]{target_word}[/bold green]"
     return pattern.sub(replacement, sentence)
 
-def display_word_bank(all_words, user_answers_values):
+def display_word_bank(sorted_words, word_norms, user_answers_values):
     """
     Displays the word bank. Handles duplicate words correctly by counting usage.
+    `sorted_words` must already be in alphabetical display order, and
+    `word_norms` maps each word to its interned normalized form.
     """
     styled_words = []
 
     # Count frequencies of user answers to handle duplicates
     # e.g., if "de" is used once, count is 1. If "de" is in word bank twice,
     # only the first instance gets struck.
-    user_counts = Counter(normalize(w) for w in user_answers_values if w)
+    user_counts = Counter(sys.intern(normalize(w)) for w in user_answers_values if w)
 
-    # Sort purely alphabetically for display
-    for word in sorted(all_words):
-        norm = normalize(word)
+    for word in sorted_words:
+        norm = word_norms[word]
         if user_counts[norm] > 0:
             # Strike through and decrement usage count so we don't strike duplicates
             # unless the user actually used the word multiple times.
@@ -89,9 +107,7 @@ def display_word_bank(all_words, user_answers_values):
     console.print(Panel(text_content, title="📖 Word Bank (Remaining options)", expand=False))
 
 def display_question(index, exercise, total, current_answer=None, is_replay=False):
-    target_word = exercise['word']
-    original_sentence = exercise['sentence']
-    masked = mask_sentence(original_sentence, target_word)
+    masked = exercise['_masked']
 
     header = f"Exercise {index + 1}/{total}"
     if is_replay:
@@ -107,14 +123,26 @@ def display_question(index, exercise, total, current_answer=None, is_replay=Fals
     console.print(Panel(content, title=header))
 
 def main():
-    console.print("[bold magenta]🇳🇱 Welcome to Your Daily Dutch Exercise![/bold magenta]")
-    console.print("Loading exercises...")
+    # Fetch in the background while the banner is printed. Errors, including
+    # the sys.exit() on failure, are re-raised here by result().
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(get_latest_exercises)
 
-    exercises = get_latest_exercises()
+        console.print("[bold magenta]🇳🇱 Welcome to Your Daily Dutch Exercise![/bold magenta]")
+        console.print("Loading exercises...")
+
+        exercises = future.result()
     total = len(exercises)
 
+    # Sentences never change during a session, so mask them once up front
+    for e in exercises:
+        e['_masked'] = mask_sentence(e['sentence'], e['word'])
+
     # Keep the raw list (including duplicates)
     word_bank_list = [e['word'] for e in exercises]
+    # Sort purely alphabetically for display, once for the whole session
+    sorted_word_bank = sorted(word_bank_list)
+    word_bank_norms = {w: sys.intern(normalize(w)) for w in word_bank_list}
 
     console.print("[dim]Instructions: Type the missing word. Type a number to jump.[/dim]\n")
 
@@ -128,7 +156,7 @@ def main():
 
         # Word Bank Display Logic
         if not is_replay and (current_index == 0 or current_index % WORD_BANK_INTERVAL == 0):
-            display_word_bank(word_bank_list, user_answers.values())
+            display_word_bank(sorted_word_bank, word_bank_norms, user_answers.values())
 
         exercise = exercises[current_index]
         existing_ans = user_answers.get(current_index)
@@ -164,7 +192,7 @@ def main():
 
     # --- END CONFIRMATION ---
     console.print("\n" + "="*50)
-    missing = [i+1 for i in range(total) if i not in user_answers]
+    missing = sorted(i + 1 for i in set(range(total)) - user_answers.keys())
     if missing:
         console.print(f"[red]Warning: You skipped: {missing}[/red]")
 
@@ -186,9 +214,11 @@ def main():
     # --- EVALUATION ---
     console.print("\n[bold]Evaluating Answers...[/bold]\n")
 
-    score = 0
-    results_vector = []
-    incorrect_indices = []
+    norm_correct = [normalize(e['word']) for e in exercises]
+    norm_user = [normalize(user_answers.get(i, "")) for i in range(total)]
+    results_vector = [1 if nc == nu else 0 for nc, nu in zip(norm_correct, norm_user)]
+    score = sum(results_vector)
+    incorrect_indices = [i for i, r in enumerate(results_vector) if not r]
 
     table = Table(title="Final Results", show_lines=True)
     table.add_column("#", style="dim", width=4)
@@ -196,19 +226,13 @@ def main():
     table.add_column("Correct Word", style="green", ratio=1)
     table.add_column("Result", justify="center")
 
-    for i in range(total):
+    for i, is_correct in enumerate(results_vector):
         correct_word = exercises[i]['word']
         user_ans = user_answers.get(i, "")
 
-        is_correct = normalize(user_ans) == normalize(correct_word)
-
         if is_correct:
-            score += 1
-            results_vector.append(1)
             table.add_row(str(i + 1), user_ans, correct_word, "✅")
         else:
-            results_vector.append(0)
-            incorrect_indices.append(i)
             style = "red strike" if user_ans else "dim"
             table.add_row(str(i + 1), Text(user_ans or "(empty)", style=style), correct_word, "❌")
 
@@ -220,14 +244,17 @@ def main():
     # --- MISTAKE REVIEW ---
     if incorrect_indices:
         console.print("\n[bold red]Reviewing Mistakes:[/bold red]")
+        # Collect everything and render it in a single print
+        parts = []
         for i in incorrect_indices:
             ex = exercises[i]
             user_ans = user_answers.get(i, "")
             corrected_sentence = format_correction(ex['sentence'], ex['word'], user_ans)
 
-            console.print(f"\n[bold]{i+1}.[/bold] {corrected_sentence}")
+            parts.append(Text.from_markup(f"\n[bold]{i+1}.[/bold] {corrected_sentence}"))
             if ex.get('english'):
-                console.print(f"   [italic dim]{ex['english']}[/italic dim]")
+                parts.append(Text(f"   {ex['english']}", style="italic dim"))
+        console.print(Group(*parts))
     else:
         console.print("\n[bold green]Flawless victory! No mistakes to review.[/bold green]")
 
@@ -1,13 +1,18 @@
 import os
+import time
+import queue
+import functools
 import sqlite3
 import random
-import json
+import orjson
 import httpx
+from contextlib import contextmanager
 from typing import List, TypedDict, Optional, Annotated
-from datetime import datetime
-from bs4 import BeautifulSoup
+from datetime import date
+from selectolax.parser import HTMLParser
 
 from fastapi import FastAPI, BackgroundTasks
+from fastapi.responses import ORJSONResponse, Response
 from pydantic import BaseModel
 
 from langchain_google_genai import ChatGoogleGenerativeAI
@@ -25,6 +30,24 @@ DB_PATH = "daily_dutch.db"
 CHECKPOINT_DB_PATH = "workflow_state.db"
 
 NUM_SENTENCES = 20
+DB_POOL_SIZE = 4
+
+# Statements reused on the pooled connections hit sqlite3's statement cache
+_INSERT_EXERCISES_SQL = "INSERT INTO daily_exercises (date, source_url, exercises_json) VALUES (?, ?, ?)"
+_INSERT_ATTEMPT_SQL = """
+    INSERT INTO user_attempts
+    (exercise_id, results, score, accuracy)
+    VALUES (?, ?, ?, ?)
+"""
+
+# Shared HTTP client: the homepage and article fetches both go to nos.nl, so
+# keep the connection (and TLS session) warm between them.
+_http = httpx.Client(
+    base_url="https://nos.nl",
+    http2=True,
+    timeout=30.0,
+    limits=httpx.Limits(max_keepalive_connections=4, max_connections=10),
+)
 
 # --- DATABASE SETUP (Business Logic) ---
 def init_db():
@@ -55,6 +78,27 @@ def init_db():
 
 init_db()
 
+# --- CONNECTION POOL ---
+# Connections are opened and configured once, then handed out per request.
+_pool = queue.Queue()
+for _ in range(DB_POOL_SIZE):
+    _conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
+    _conn.row_factory = sqlite3.Row
+    _conn.execute("PRAGMA journal_mode=WAL")
+    _conn.execute("PRAGMA synchronous=NORMAL")
+    _pool.put(_conn)
+
+@contextmanager
+def get_conn():
+    """Borrow a pooled connection, rolling back anything left uncommitted."""
+    conn = _pool.get()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        _pool.put(conn)
+
 # --- Pydantic Models for API ---
 class TriggerRequest(BaseModel):
     suggested_words: List[str] = ["bezig", "afhankelijk", "gereedschap", "omgaan", "ondanks"]
@@ -71,25 +115,65 @@ class AgentState(Exercises):
 
 # --- NODE FUNCTIONS ---
 
+EXERCISE_PROMPT = """
+    You are a Dutch language teacher creating exercises.
+
+    CONTEXT ARTICLE:
+    {article_text}
+
+    TARGET WORDS TO INCLUDE:
+    {suggested_words}
+
+    TASK:
+    1. Extract or create {num_sentences} simplified sentences based on the context. Try to
+       include the target words in at least {subset_sentences} of the {num_sentences} sentences.
+    2. Choose one word per sentence that is self-evident from context, again focusing on
+       the target words as much as possible.
+    3. Include a field with the English translation.
+    4. Respond ONLY with a valid JSON list.
+
+    FORMAT EXAMPLE:
+    [
+      {{"sentence": "Het schrijven van een brief is een lastige klus.", "word": "klus", "english", "Writing a letter is a difficult task."}},
+      ...
+    ]
+    """
+
+@functools.lru_cache(maxsize=1)
+def get_exercise_chain():
+    """
+    Builds the prompt | llm | parser chain on first use and reuses it, so the
+    Gemini client and its connections persist across runs.
+    """
+    llm = ChatGoogleGenerativeAI(
+        model="gemini-2.5-flash",
+        temperature=0.7
+    )
+    prompt = ChatPromptTemplate.from_template(EXERCISE_PROMPT)
+    return prompt | llm | JsonOutputParser()
+
 def pick_article_node(state: AgentState):
     """Scrapes NOS.nl homepage and picks a random article URL."""
     print("--- Step 1: Picking Article ---")
     try:
-        response = httpx.get("https://nos.nl")
-        soup = BeautifulSoup(response.content, "html.parser")
-
-        # Find links that look like articles
-        links = [
-            a['href'] for a in soup.find_all('a', href=True)
-            if '/artikel/' in a['href']
-        ]
-
-        if not links:
+        response = _http.get("/")
+        tree = HTMLParser(response.content)
+
+        # Pick one unique article link uniformly at random in a single pass
+        # (reservoir sampling), without building a list of all links
+        seen = set()
+        selected_path = None
+        for a in tree.css('a[href*="/artikel/"]'):
+            href = a.attributes['href']
+            if href in seen:
+                continue
+            seen.add(href)
+            if random.randrange(len(seen)) == 0:
+                selected_path = href
+
+        if selected_path is None:
             return {"error": "No articles found"}
 
-        # Deduplicate and pick one
-        unique_links = list(set(links))
-        selected_path = random.choice(unique_links)
         full_url = f"https://nos.nl{selected_path}"
 
         return {"article_url": full_url}
@@ -103,18 +187,15 @@ def scrape_content_node(state: AgentState):
 
     print(f"--- Step 2: Scraping {state['article_url']} ---")
     try:
-        response = httpx.get(state['article_url'])
-        soup = BeautifulSoup(response.content, "html.parser")
+        response = _http.get(state['article_url'])
+        tree = HTMLParser(response.content)
 
         # NOS articles usually have content in <p> tags inside an <article> or specific classes
         # This is a generic robust approach
-        article_body = soup.find('article')
-        if article_body:
-            paragraphs = article_body.find_all('p')
-        else:
-            paragraphs = soup.find_all('p')
+        article_body = tree.css_first('article')
+        paragraphs = (article_body if article_body is not None else tree).css('p')
 
-        text_content = " ".join([p.get_text() for p in paragraphs])
+        text_content = " ".join(p.text() for p in paragraphs)
 
         # Limit text length to avoid token limits if necessary
         return {"article_text": text_content[:8000]}
@@ -128,42 +209,8 @@ def generate_exercises_node(state: AgentState):
 
     print("--- Step 3: Generating Exercises with Gemini ---")
 
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-2.5-flash",
-        temperature=0.7
-    )
-
-    parser = JsonOutputParser()
-
-    prompt_text = """
-    You are a Dutch language teacher creating exercises.
-
-    CONTEXT ARTICLE:
-    {article_text}
-
-    TARGET WORDS TO INCLUDE:
-    {suggested_words}
-
-    TASK:
-    1. Extract or create {num_sentences} simplified sentences based on the context. Try to
-       include the target words in at least {subset_sentences} of the {num_sentences} sentences.
-    2. Choose one word per sentence that is self-evident from context, again focusing on
-       the target words as much as possible.
-    3. Include a field with the English translation.
-    4. Respond ONLY with a valid JSON list.
-
-    FORMAT EXAMPLE:
-    [
-      {{"sentence": "Het schrijven van een brief is een lastige klus.", "word": "klus", "english", "Writing a letter is a difficult task."}},
-      ...
-    ]
-    """
-
-    prompt = ChatPromptTemplate.from_template(prompt_text)
-    chain = prompt | llm | parser
-
     try:
-        result = chain.invoke({
+        result = get_exercise_chain().invoke({
             "article_text": state['article_text'],
             "suggested_words": ", ".join(state['suggested_words']),
             "num_sentences": NUM_SENTENCES,
@@ -181,18 +228,12 @@ def save_to_db_node(state: Exercises):
 
     print("--- Step 4: Saving to Database ---")
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        json_data = orjson.dumps(state["exercises"]).decode()
+        today = date.today().isoformat()
 
-        json_data = json.dumps(state["exercises"], ensure_ascii=False)
-        today = datetime.now().strftime("%Y-%m-%d")
-
-        cursor.execute(
-            "INSERT INTO daily_exercises (date, source_url, exercises_json) VALUES (?, ?, ?)",
-            (today, state['article_url'], json_data)
-        )
-        conn.commit()
-        conn.close()
+        with get_conn() as conn:
+            conn.execute(_INSERT_EXERCISES_SQL, (today, state['article_url'], json_data))
+            conn.commit()
         return {"error": None} # Success
     except Exception as e:
         return {"error": str(e)}
@@ -223,7 +264,7 @@ app_graph = workflow.compile(checkpointer=memory)
 
 # --- FASTAPI APP ---
 
-app = FastAPI(title="Dutch Learning Agent")
+app = FastAPI(title="Dutch Learning Agent", default_response_class=ORJSONResponse)
 
 def run_agent_background(words: List[str], thread_id: str):
     """Helper to run the graph configuration"""
@@ -247,7 +288,7 @@ def run_agent_background(words: List[str], thread_id: str):
 async def trigger_exercise(request: TriggerRequest, background_tasks: BackgroundTasks):
     # Create a unique ID for this run (e.g., today's date) to ensure we can resume it
     # or a UUID for unique runs.
-    run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+    run_id = time.strftime("%Y%m%d-%H%M%S")
 
     # Add to background tasks so the API returns immediately
     background_tasks.add_task(run_agent_background, request.suggested_words, run_id)
@@ -261,22 +302,23 @@ async def trigger_exercise(request: TriggerRequest, background_tasks: Background
 @app.get("/exercises")
 def get_exercises():
     """View generated exercises from the DB"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM daily_exercises ORDER BY created_at DESC LIMIT 1")
-    rows = cursor.fetchall()
-    conn.close()
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = None  # Plain tuples
+        cursor.execute(
+            "SELECT id, date, source_url, exercises_json FROM daily_exercises ORDER BY created_at DESC LIMIT 1"
+        )
+        rows = cursor.fetchall()
 
-    results = []
-    for row in rows:
-        results.append({
-            "id": row["id"],
-            "date": row["date"],
-            "url": row["source_url"],
-            "exercises": json.loads(row["exercises_json"])
-        })
-    return results
+    # exercises_json is stored as valid JSON, so splice it into the response
+    # as-is rather than parsing it only to serialize it again
+    body = b"[" + b",".join(
+        b'{"id":%d,"date":%s,"url":%s,"exercises":%s}' % (
+            row_id, orjson.dumps(row_date), orjson.dumps(url), exercises_json.encode()
+        )
+        for row_id, row_date, url, exercises_json in rows
+    ) + b"]"
+    return Response(body, media_type="application/json")
 
 @app.put("/exercises")
 def put_exercises(exercises: Exercises):
@@ -295,38 +337,31 @@ def accept_results(payload: ResultsPayload):
     Accept results measured by an external script, calculate stats,
     and store in a separate history table.
     """
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-
-    # Find the ID of the latest exercise
-    cursor.execute("SELECT id FROM daily_exercises ORDER BY created_at DESC LIMIT 1")
-    latest_row = cursor.fetchone()
+    with get_conn() as conn:
+        cursor = conn.cursor()
 
-    if latest_row:
-        exercise_id = latest_row['id']
-        results = payload.results
+        # Find the ID of the latest exercise
+        cursor.execute("SELECT id FROM daily_exercises ORDER BY created_at DESC LIMIT 1")
+        latest_row = cursor.fetchone()
 
-        # 3. Calculate statistics
-        score = sum(results)
-        total = len(results)
-        accuracy = int((score / total) * 100) if total > 0 else 0
+        if latest_row:
+            exercise_id = latest_row['id']
+            results = payload.results
 
-        results_str = json.dumps(results)
+            # 3. Calculate statistics
+            score = sum(results)
+            total = len(results)
+            accuracy = int((score / total) * 100) if total > 0 else 0
 
-        # 4. Insert the new attempt record
-        cursor.execute("""
-            INSERT INTO user_attempts
-            (exercise_id, results, score, accuracy)
-            VALUES (?, ?, ?, ?)
-        """, (exercise_id, results_str, score, accuracy))
+            results_str = orjson.dumps(results).decode()
 
-        conn.commit()
-        status = "success"
-    else:
-        status = "error: no exercises found to link results to"
+            # 4. Insert the new attempt record
+            cursor.execute(_INSERT_ATTEMPT_SQL, (exercise_id, results_str, score, accuracy))
 
-    conn.close()
+            conn.commit()
+            status = "success"
+        else:
+            status = "error: no exercises found to link results to"
 
     return {"result": status}
 
@@ -11,6 +11,11 @@ app = FastAPI()
 DEFAULT_COMMAND = f"{sys.executable} -i -q"
 DEFAULT_COMMAND = "uv run scripts/exercise.py"
 
+# Output is batched into one WebSocket frame per FLUSH_BYTES or FLUSH_INTERVAL
+FLUSH_BYTES = 4096
+FLUSH_INTERVAL = 0.016  # seconds, about one display frame
+READ_SIZE = 65536  # Matches the Linux pipe buffer, so one read drains it
+
 html = """<!DOCTYPE html>
 <html lang="en">
 <head>
@@ -54,6 +59,8 @@ html = """<!DOCTYPE html>
             });
 
             const socket = new WebSocket(`ws://${window.location.host}/ws`);
+            // Output arrives as raw bytes; xterm.js decodes UTF-8 itself
+            socket.binaryType = "arraybuffer";
 
             terminal.open(terminalDiv);
 
@@ -62,7 +69,10 @@ html = """<!DOCTYPE html>
 
             socket.onmessage = function(event) {
                 // Write output from server directly to terminal
-                terminal.write(event.data);
+                if (event.data instanceof ArrayBuffer)
+                    terminal.write(new Uint8Array(event.data));
+                else
+                    terminal.write(event.data);
             };
 
             socket.onclose = function() {
@@ -148,25 +158,31 @@ async def execute_command(websocket: WebSocket, command: str):
 
     print(f"Started process: {command}")
 
-    async def read_stdout():
-        try:
-            while True:
-                data = await process.stdout.read(1024)
+    async def pump(stream):
+        # Coalesce output into fewer WebSocket frames: send once FLUSH_BYTES
+        # have accumulated or FLUSH_INTERVAL has passed since the last send.
+        loop = asyncio.get_running_loop()
+        buf = bytearray()
+        last_flush = loop.time()
+        while True:
+            timeout = max(0, last_flush + FLUSH_INTERVAL - loop.time()) if buf else None
+            try:
+                data = await asyncio.wait_for(stream.read(READ_SIZE), timeout)
+            except TimeoutError:
+                data = None  # Timer expired, flush what we have
+            else:
                 if not data:
                     break
-                await websocket.send_text(data.decode('utf-8', errors='replace'))
-        except Exception:
-            pass
+                buf += data
 
-    async def read_stderr():
-        try:
-            while True:
-                data = await process.stderr.read(1024)
-                if not data:
-                    break
-                await websocket.send_text(data.decode('utf-8', errors='replace'))
-        except Exception:
-            pass
+            if buf and (data is None or len(buf) >= FLUSH_BYTES
+                        or loop.time() - last_flush >= FLUSH_INTERVAL):
+                await websocket.send_bytes(bytes(buf))
+                buf.clear()
+                last_flush = loop.time()
+
+        if buf:
+            await websocket.send_bytes(bytes(buf))
 
     async def write_stdin():
         try:
@@ -175,20 +191,24 @@ async def execute_command(websocket: WebSocket, command: str):
                 # data already contains \n from the frontend
                 process.stdin.write(data.encode('utf-8'))
                 await process.stdin.drain()
-        except WebSocketDisconnect:
+        except (WebSocketDisconnect, BrokenPipeError, ConnectionResetError):
+            # Client went away, or the process exited and closed its stdin
             pass
-        except Exception:
-            pass
-
-    stdout_task = asyncio.create_task(read_stdout())
-    stderr_task = asyncio.create_task(read_stderr())
-    stdin_task = asyncio.create_task(write_stdin())
 
-    await process.wait()
+    # If any task fails, the group cancels its siblings and raises the error
+    try:
+        async with asyncio.TaskGroup() as tg:
+            stdin_task = tg.create_task(write_stdin())
+            readers = [tg.create_task(pump(process.stdout)),
+                       tg.create_task(pump(process.stderr))]
+
+            await process.wait()
+            await asyncio.wait(readers)  # Send any remaining output
+            stdin_task.cancel()
+    finally:
+        if process.returncode is None:
+            process.kill()
 
-    stdin_task.cancel()
-    await stdout_task
-    await stderr_task
     await websocket.close()
     print("Process finished")
 
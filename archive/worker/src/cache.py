@@ -0,0 +1,25 @@
+import time
+
+class TTLCache:
+    """Small dict-based cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = {}
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    def set(self, key, value):
+        if key not in self._data and len(self._data) >= self.maxsize:
+            # dicts keep insertion order, so the first key is the oldest
+            del self._data[next(iter(self._data))]
+        self._data[key] = (time.monotonic() + self.ttl, value)
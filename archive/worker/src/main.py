@@ -1,13 +1,21 @@
 import os
+import hashlib
+import random
+import asyncio
 import logging
 import httpx
+import orjson
+from contextlib import asynccontextmanager
 from typing import Annotated
-from fastapi import FastAPI, BackgroundTasks, Depends, HTTPException, status
-from pydantic import BaseModel
+from fastapi import FastAPI, Depends, HTTPException, Request, status
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ValidationError
 
 from langchain.chat_models import init_chat_model
 from langchain_core.prompt_values import ChatPromptValue
 
+from .cache import TTLCache
 from .security import verify_jwt
 
 # --- LOGGING CONFIGURATION ---
@@ -16,26 +24,131 @@ from .security import verify_jwt
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("uvicorn.error") # Merges with uvicorn logs
 
+# Quiz generation is bounded: each of the QUIZ_WORKERS workers takes up to
+# QUIZ_BATCH_MAX queued quizzes at once and runs their LLM calls concurrently,
+# and at most QUIZ_QUEUE_SIZE requests wait before new ones are refused.
+QUIZ_WORKERS = int(os.getenv("QUIZ_WORKERS", "2"))
+QUIZ_BATCH_MAX = int(os.getenv("QUIZ_BATCH_MAX", "4"))
+QUIZ_QUEUE_SIZE = 64
+# On shutdown, seconds to let queued and running quizzes finish before
+# the rest are reported to the webhook as failed
+QUIZ_SHUTDOWN_GRACE = float(os.getenv("QUIZ_SHUTDOWN_GRACE", "30"))
+# Total time then allowed for those failure reports, one attempt each.
+# The container's stop grace period must exceed the sum of both timeouts.
+QUIZ_SHUTDOWN_NOTIFY_TIMEOUT = float(os.getenv("QUIZ_SHUTDOWN_NOTIFY_TIMEOUT", "5"))
+
+# Webhook posts are retried on transport errors and 5xx responses
+WEBHOOK_ATTEMPTS = 4
+
+# Identical prompts give identical quizzes when sampling is deterministic,
+# so generated exercises are cached by prompt hash for a while.
+CACHE_MAX_ENTRIES = 1024
+CACHE_TTL = 3600.0
+
+def prompt_cache_key(messages: list[dict]) -> bytes:
+    """
+    Hash of the messages with whitespace collapsed, so that prompts which
+    differ only in spacing or line breaks share a cache entry.
+    """
+    canonical = [[m['role'], ' '.join(m['content'].split())] for m in messages]
+    return hashlib.sha256(orjson.dumps(canonical)).digest()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One HTTP client for all webhook calls, so connections are pooled and reused
+    app.state.http = httpx.AsyncClient(
+        timeout=30.0,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100, keepalive_expiry=30),
+    )
+    # The structured-output LLM is stateless across calls, so build it once
+    llm_config = get_llm_config()
+    app.state.llm = init_chat_model(**llm_config).with_structured_output(QuizResponse)
+    # Only a temperature of zero makes the response a function of the prompt
+    app.state.cache = TTLCache(CACHE_MAX_ENTRIES, CACHE_TTL) if llm_config.get('temperature') == 0 else None
+    app.state.queue = asyncio.Queue(maxsize=QUIZ_QUEUE_SIZE)
+    # Requests taken off the queue by a worker but not yet finished
+    in_flight = {}
+    workers = [
+        asyncio.create_task(quiz_worker(app.state.queue, app.state.http, app.state.llm, app.state.cache, in_flight))
+        for _ in range(QUIZ_WORKERS)
+    ]
+    yield
+
+    # Give queued and running quizzes a chance to finish
+    try:
+        await asyncio.wait_for(app.state.queue.join(), QUIZ_SHUTDOWN_GRACE)
+    except TimeoutError:
+        logger.warning(f"Shutdown | Quizzes still pending after {QUIZ_SHUTDOWN_GRACE}s, cancelling")
+    for w in workers:
+        w.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+    # Tell the webhook about any quiz that will now never be generated
+    unfinished = list(in_flight.values())
+    while not app.state.queue.empty():
+        unfinished.append(app.state.queue.get_nowait())
+    try:
+        await asyncio.wait_for(asyncio.gather(*(
+            send_error_webhook(app.state.http, request, webhook_headers(request),
+                               "Quiz worker shut down before the quiz was generated", attempts=1)
+            for request in unfinished
+        )), QUIZ_SHUTDOWN_NOTIFY_TIMEOUT)
+    except TimeoutError:
+        logger.critical(f"Shutdown | Gave up reporting unfinished quizzes after {QUIZ_SHUTDOWN_NOTIFY_TIMEOUT}s")
+    await app.state.http.aclose()
+
 # FastAPI app
-app = FastAPI(title="Quiz Worker")
+app = FastAPI(title="Quiz Worker", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Environment
 def get_llm_config():
-    return {
+    config = {
         'api_key': os.environ.get('LLM_API_KEY', 'lm-studio'),
         'base_url': os.environ.get('LLM_BASE_URL', 'http://localhost:1234/v1'),
         'model': os.environ.get('LLM_MODEL', 'local-model'),
         'model_provider': os.environ.get('LLM_PROVIDER', 'openai') or 'openai',
     }
+    temperature = os.environ.get('LLM_TEMPERATURE')
+    if temperature:
+        config['temperature'] = float(temperature)
+    return config
 
 # --- Pydantic Models for API ---
+class PromptMessage(BaseModel):
+    id: list[str] # e.g. ["langchain", "schema", "messages", "HumanMessage"]
+    kwargs: dict
+
+class PromptBody(BaseModel):
+    kwargs: dict[str, list[PromptMessage]]
+
 class QuizRequest(BaseModel):
-    prompt: dict # ChatPromptValue
+    prompt: PromptBody # serialized ChatPromptValue
     quiz_id: int
     user_id: str
     webhook: str
     user_token: str
 
+def _inline_refs(schema: dict) -> dict:
+    """Replace `$ref`s into `$defs` with the definitions themselves."""
+    defs = schema.pop('$defs', {})
+    def resolve(node):
+        if isinstance(node, dict):
+            if '$ref' in node:
+                return resolve(defs[node['$ref'].rsplit('/', 1)[-1]])
+            return {k: resolve(v) for k, v in node.items()}
+        if isinstance(node, list):
+            return [resolve(v) for v in node]
+        return node
+    return resolve(schema)
+
+# generate_quiz reads the raw body, so its schema is declared by hand
+QUIZ_REQUEST_OPENAPI = {
+    'requestBody': {
+        'required': True,
+        'content': {'application/json': {'schema': _inline_refs(QuizRequest.model_json_schema())}},
+    },
+}
+
 class QuizQuestion(BaseModel):
     question: str
     answer: str
@@ -47,99 +160,211 @@ class QuizResponse(BaseModel):
 class UserHealthRequest(BaseModel):
     user_id: str
 
-async def process_quiz_generation(request: QuizRequest):
+# Serialized LangChain message class name -> chat role
+_ROLE_MAP = {
+    'HumanMessage': 'user',
+    'AIMessage': 'chatbot',
+    'SystemMessage': 'system',
+}
+
+async def post_with_retry(client: httpx.AsyncClient, url: str, *, headers: dict, content: bytes,
+                          attempts: int = WEBHOOK_ATTEMPTS):
+    """
+    POST to a webhook, retrying transport errors and 5xx responses with
+    exponential backoff and jitter.  Returns the last response, or None if
+    the webhook could not be reached at all.
+    """
+    response = None
+    for attempt in range(attempts):
+        try:
+            response = await client.post(url, headers=headers, content=content, timeout=30.0)
+            if response.status_code < 500:
+                if response.status_code >= 400:
+                    logger.error(f"Webhook Rejected | Status: {response.status_code} | {response.text[:512]}")
+                return response
+            logger.warning(f"Webhook Attempt {attempt + 1} | Status: {response.status_code} | {response.text[:512]}")
+        except httpx.TransportError as e:
+            logger.warning(f"Webhook Attempt {attempt + 1} | Error: {e}")
+        if attempt + 1 < attempts:
+            await asyncio.sleep(min(8, 0.5 * 2**attempt) + random.random() * 0.1)
+    return response
+
+def webhook_headers(request: QuizRequest) -> dict:
+    return {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {request.user_token}',
+    }
+
+async def send_error_webhook(client: httpx.AsyncClient, request: QuizRequest, headers: dict, error_details: str,
+                             attempts: int = WEBHOOK_ATTEMPTS):
+    """
+    Report a failed generation to the webhook, so the quiz does not stay
+    in progress forever.  Never raises.
+    """
+    try:
+        response = await post_with_retry(
+            client,
+            request.webhook,
+            headers=headers,
+            content=orjson.dumps({
+                'user_id': request.user_id,
+                'quiz_id': request.quiz_id,
+                'questions': None,
+                'status': 'error',
+                'error_details': error_details
+            }),
+            attempts=attempts,
+        )
+        if response is None or not response.is_success:
+            status_code = response.status_code if response is not None else "unreachable"
+            logger.critical(f"Webhook Failed | Could not notify Supabase of error for quiz {request.quiz_id} | Status: {status_code}")
+        else:
+            logger.critical(f"Error Webhook Sent | Result: {response.status_code}")
+    except Exception as hook_err:
+        logger.critical(f"Webhook Failed | Could not notify Supabase of error: {hook_err}")
+
+async def process_quiz_generation(request: QuizRequest, client: httpx.AsyncClient, llm, cache=None):
     """
-    Background task that calls the LLM and sends the result via webhook.
+    Background task that calls the LLM and sends the result via webhook,
+    using the shared `client` and structured-output `llm`.  If `cache` is
+    given, exercises for an identical prompt are reused instead.
     """
     logger.info(f"Task Started | Quiz ID: {request.quiz_id} | User: {request.user_id}")
 
-    # Initialize LLM
-    llm = init_chat_model(**get_llm_config()).with_structured_output(QuizResponse)
+    # Same headers for the success and error webhooks, and for every retry
+    headers = webhook_headers(request)
 
     try:
         # Reconstruct messages from the raw prompt dictionary
         messages = [
-            {'role': {'HumanMessage': 'user',
-                      'AIMessage': 'chatbot',
-                      'SystemMessage': 'system'}[m['id'][-1]],
-             'content': m['kwargs']['content']
-             }
-            for m in request.prompt['kwargs']['messages']
+            {'role': _ROLE_MAP.get(m.id[-1], 'user'), 'content': m.kwargs['content']}
+            for m in request.prompt.kwargs['messages']
         ]
 
-        # Invoke LLM
-        result = await llm.ainvoke(messages)
+        key = None
+        exercises_data = None
+        if cache is not None:
+            key = prompt_cache_key(messages)
+            exercises_data = cache.get(key)
 
-        # Send webhook to save the results
-        async with httpx.AsyncClient() as client:
+        if exercises_data is None:
+            # Invoke LLM
+            result = await llm.ainvoke(messages)
             logger.info(f"LLM Success | Quiz {request.quiz_id} | Sending Webhook...")
 
-            # Extract data safely
-            exercises_data = result.model_dump()['exercises'] if hasattr(result, 'model_dump') else result.dict()['exercises']
-
-            response = await client.post(
-                request.webhook,
-                headers={
-                    'Content-Type': 'application/json',
-                    'Authorization': 'Bearer ' + request.user_token,
-                },
-                json={
-                    'user_id': request.user_id,
-                    'quiz_id': request.quiz_id,
-                    'questions': exercises_data,
-                    'status': 'ready'
-                },
-                timeout=30.0
-            )
+            # with_structured_output returns a QuizResponse instance
+            exercises_data = [e.model_dump(mode="json") for e in result.exercises]
+            if key is not None:
+                cache.set(key, exercises_data)
+        else:
+            logger.info(f"Cache Hit | Quiz {request.quiz_id} | Sending Webhook...")
+
+        # Send webhook to save the results
+
+        response = await post_with_retry(
+            client,
+            request.webhook,
+            headers=headers,
+            content=orjson.dumps({
+                'user_id': request.user_id,
+                'quiz_id': request.quiz_id,
+                'questions': exercises_data,
+                'status': 'ready'
+            }),
+        )
+        if response is None:
+            logger.critical(f"Webhook Failed | Quiz {request.quiz_id} | Could not reach webhook")
+        elif not response.is_success:
+            logger.critical(f"Webhook Failed | Quiz {request.quiz_id} | Status: {response.status_code}")
+        else:
             logger.info(f"Webhook Success | Quiz {request.quiz_id} | Status: {response.status_code}")
 
     except Exception as e:
         logger.error(f"Task Failed | Quiz {request.quiz_id} | Error: {str(e)}")
-        async with httpx.AsyncClient() as client:
+        await send_error_webhook(client, request, headers, str(e))
+
+async def quiz_worker(queue: asyncio.Queue, client: httpx.AsyncClient, llm, cache, in_flight: dict):
+    """
+    Long-lived consumer that waits for a queued quiz, then also takes any
+    others already waiting (up to QUIZ_BATCH_MAX) and generates them
+    concurrently, so the LLM server can batch them.  Requests being
+    worked on are kept in `in_flight` until they complete.
+    """
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < QUIZ_BATCH_MAX:
             try:
-                response = await client.post(
-                    request.webhook,
-                    headers={
-                        'Content-Type': 'application/json',
-                        'Authorization': 'Bearer ' + request.user_token,
-                    },
-                    json={
-                        'user_id': request.user_id,
-                        'quiz_id': request.quiz_id,
-                        'questions': None,
-                        'status': 'error',
-                        'error_details': str(e)
-                    },
-                    timeout=30.0
-                )
-                logger.critical(f"Error Webhook Sent | Result: {response.status_code}")
-            except Exception as hook_err:
-                logger.critical(f"Webhook Failed | Could not notify Supabase of error: {hook_err}")
-
-
-@app.post('/generate_quiz')
+                batch.append(queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        in_flight.update((id(request), request) for request in batch)
+        try:
+            results = await asyncio.gather(
+                *(process_quiz_generation(request, client, llm, cache) for request in batch),
+                return_exceptions=True,
+            )
+            for request, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Worker Error | Quiz {request.quiz_id} | Error: {result}")
+            # Not in `finally`: a cancelled batch stays in flight for shutdown to report
+            for request in batch:
+                del in_flight[id(request)]
+        finally:
+            for _ in batch:
+                queue.task_done()
+
+
+@app.post('/generate_quiz', openapi_extra=QUIZ_REQUEST_OPENAPI)
 async def generate_quiz(
-    request: QuizRequest,
-    background_tasks: BackgroundTasks,
+    raw: Request,
     jwt_payload: Annotated[dict, Depends(verify_jwt)]
 ):
     """
-    Accepts the request and schedules the generation in the background.
-    Returns immediately.
+    Accepts the request and queues the generation for a background worker.
+    Returns immediately, or 503 if the queue is full.
     """
+    # Errors below are raised in the same shape FastAPI uses for body parameters
+    try:
+        body = orjson.loads(await raw.body())
+    except orjson.JSONDecodeError as e:
+        raise RequestValidationError([{
+            'type': 'json_invalid',
+            'loc': ('body', e.pos),
+            'msg': 'JSON decode error',
+            'input': {},
+            'ctx': {'error': e.msg},
+        }])
 
     # SECURITY CROSS-CHECK:
-    # Ensure the user_id in the JSON body is the same as the one in the verified JWT
-    if request.user_id != jwt_payload.get("sub"):
-        logger.warning(f"Security Alert | User {jwt_payload.get('sub')} tried to generate quiz for {request.user_id}")
+    # Ensure the user_id in the JSON body is the same as the one in the verified JWT.
+    # A well-formed but foreign user_id is refused before validating the (possibly
+    # large) prompt; a missing or mistyped one is left to validation below (422).
+    user_id = body.get("user_id") if isinstance(body, dict) else None
+    if isinstance(user_id, str) and user_id != jwt_payload.get("sub"):
+        logger.warning(f"Security Alert | User {jwt_payload.get('sub')} tried to generate quiz for {user_id}")
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="User ID mismatch. You can only generate quizzes for yourself."
         )
 
-    logger.info(f"Request Accepted | Quiz {request.quiz_id} queued for user {request.user_id}")
+    try:
+        # from_attributes, as FastAPI uses, so non-object bodies report model_attributes_type
+        request = QuizRequest.model_validate(body, from_attributes=True)
+    except ValidationError as e:
+        raise RequestValidationError([
+            {**err, 'loc': ('body', *err['loc'])} for err in e.errors(include_url=False)
+        ])
+
+    try:
+        app.state.queue.put_nowait(request)
+    except asyncio.QueueFull:
+        logger.warning(f"Queue Full | Quiz {request.quiz_id} rejected for user {request.user_id}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many quizzes are being generated. Please try again later."
+        )
 
-    background_tasks.add_task(process_quiz_generation, request)
+    logger.info(f"Request Accepted | Quiz {request.quiz_id} queued for user {request.user_id}")
 
     # Respond immediately to the caller
     return {
@@ -179,5 +404,15 @@ async def health():
 
 if __name__ == "__main__":
     import uvicorn
-    # Use log_level="info" to ensure uvicorn passes our logs through
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
+    # Use log_level="info" to ensure uvicorn passes our logs through.
+    # Each worker process has its own HTTP client, LLM, queue and caches;
+    # an import string is needed so uvicorn can spawn more than one.
+    uvicorn.run(
+        "src.main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", "2")),
+        loop="uvloop",
+        http="httptools",
+        log_level="info",
+    )
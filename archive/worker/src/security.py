@@ -1,53 +1,119 @@
 import os
+import asyncio
 import logging
+from urllib.parse import urlparse
 from fastapi import HTTPException, Security
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import jwt # PyJWT library
 from jwt.exceptions import PyJWTError, PyJWKClientError
 
+from .cache import TTLCache
+
 # Load trusted projects from an environment variable (comma-separated)
 # SUPABASE_PROJECTS="project-a.supabase.co,project-b.supabase.co"
-TRUSTED_DOMAINS = os.getenv("SUPABASE_PROJECTS", "").split(",")
+TRUSTED_DOMAINS = frozenset(d.strip().lower() for d in os.getenv("SUPABASE_PROJECTS", "").split(",") if d.strip())
 
 security = HTTPBearer()
 
 logger = logging.getLogger("uvicorn.error") # Merges with uvicorn logs
 
+if not TRUSTED_DOMAINS:
+    logger.warning("SUPABASE_PROJECTS is empty; every token will be rejected as untrusted")
+
 # We use a dictionary to cache JWK clients for each project
 jwks_clients = {}
+_jwks_lock = asyncio.Lock()
+
+async def get_jwks_client(domain: str):
+    client = jwks_clients.get(domain)
+    if client is not None:
+        return client
+    async with _jwks_lock:
+        # Re-check, so a burst of first requests builds only one client
+        client = jwks_clients.get(domain)
+        if client is None:
+            # Construct the standard Supabase JWKS URL
+            url = f"https://{domain}/auth/v1/.well-known/jwks.json"
+            client = jwks_clients[domain] = jwt.PyJWKClient(url, cache_keys=True)
+        return client
+
+# Signing keys by (domain, kid), so that the JWKS is only consulted on a miss
+KEY_CACHE_MAX_ENTRIES = 128
+KEY_CACHE_TTL = 3600.0
+_key_cache = TTLCache(KEY_CACHE_MAX_ENTRIES, KEY_CACHE_TTL)
+# Kids missing from their domain's JWKS, remembered briefly so that repeated
+# tokens with a bogus kid do not each force a JWKS refetch
+UNKNOWN_KID_TTL = 60.0
+_unknown_kids = TTLCache(KEY_CACHE_MAX_ENTRIES, UNKNOWN_KID_TTL)
+# One lock per (domain, kid), so a slow fetch only holds up requests for that key
+_key_locks = {}
 
-def get_jwks_client(domain: str):
-    if domain not in jwks_clients:
-        # Construct the standard Supabase JWKS URL
-        url = f"https://{domain}/auth/v1/.well-known/jwks.json"
-        jwks_clients[domain] = jwt.PyJWKClient(url, cache_keys=True)
-    return jwks_clients[domain]
+def _cached_signing_key(cache_key):
+    if _unknown_kids.get(cache_key):
+        raise PyJWKClientError(f'Unable to find a signing key that matches: "{cache_key[1]}"')
+    return _key_cache.get(cache_key)
+
+async def get_signing_key(domain: str, kid: str):
+    cache_key = (domain, kid)
+    key = _cached_signing_key(cache_key)
+    if key is not None:
+        return key
+    lock = _key_locks.setdefault(cache_key, asyncio.Lock())
+    try:
+        async with lock:
+            # Another request may have fetched it while we waited
+            key = _cached_signing_key(cache_key)
+            if key is not None:
+                return key
+            # May fetch the JWKS over the network, so keep it off the event loop
+            jwks_client = await get_jwks_client(domain)
+            jwk = jwks_client.match_kid(await asyncio.to_thread(jwks_client.get_signing_keys), kid)
+            if jwk is None:
+                # The keys may have been rotated since they were cached
+                jwk = jwks_client.match_kid(await asyncio.to_thread(jwks_client.get_signing_keys, True), kid)
+            if jwk is None:
+                _unknown_kids.set(cache_key, True)
+                raise PyJWKClientError(f'Unable to find a signing key that matches: "{kid}"')
+            _key_cache.set(cache_key, jwk.key)
+            return jwk.key
+    finally:
+        # Later requests are answered from the caches, so the lock can go
+        if _key_locks.get(cache_key) is lock:
+            del _key_locks[cache_key]
 
 async def verify_jwt(cred: HTTPAuthorizationCredentials = Security(security)):
     token = cred.credentials
     try:
         # Get the 'iss' claim without verifying yet
-        unverified_payload = jwt.decode(token, options={"verify_signature": False})
+        unverified_payload = jwt.decode(token, options={"verify_signature": False, "verify_exp": False})
         issuer_url = unverified_payload.get("iss", "") # e.g., "https://xyz.supabase.co/auth/v1"
 
-        # Extract the domain and check the whitelist
-        domain = issuer_url.replace("https://", "").replace("/auth/v1", "")
+        # Extract the domain and check the whitelist, before any JWKS or crypto work
+        parsed = urlparse(issuer_url)
+        if parsed.scheme != "https" or parsed.path.rstrip("/") != "/auth/v1":
+            raise HTTPException(status_code=403, detail="Untrusted issuer")
+        domain = parsed.hostname
 
         if domain not in TRUSTED_DOMAINS:
             raise HTTPException(status_code=403, detail="Untrusted issuer")
 
-        # Get the cached client and verify for real
-        jwks_client = get_jwks_client(domain)
-        signing_key = jwks_client.get_signing_key_from_jwt(token)
+        # Get the cached signing key and verify for real
+        kid = jwt.get_unverified_header(token).get("kid")
+        signing_key = await get_signing_key(domain, kid)
 
-        data = jwt.decode(
+        # Signature verification is CPU-bound, so run it off the event loop
+        data = await asyncio.to_thread(
+            jwt.decode,
             token,
-            signing_key.key,
+            signing_key,
             algorithms=["RS256", "ES256"],
             audience="authenticated",
-            issuer=issuer_url
+            issuer=issuer_url,
+            options={"require": ["iss", "sub", "exp"]}
         )
         return data
+    except HTTPException:
+        raise
     except PyJWKClientError as e:
         # This triggers if the worker can't REACH the Supabase URL
         # or if the kid isn't actually in the response.
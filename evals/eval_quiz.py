@@ -1,9 +1,13 @@
 import os
 import json
+import time
 import uuid
+import atexit
 import argparse
+import itertools
 import asyncio
 import httpx
+import orjson
 import pandas as pd
 from typing import List, Dict, Any
 from dotenv import load_dotenv
@@ -11,10 +15,10 @@ from tqdm import tqdm
 from supabase import create_client, Client
 
 from deepeval import evaluate
-from deepeval.evaluate import DisplayConfig, AsyncConfig
+from deepeval.evaluate import DisplayConfig, AsyncConfig, CacheConfig
 from deepeval.models import GPTModel
 from deepeval.test_case import LLMTestCase, LLMTestCaseParams
-from deepeval.metrics import GEval, BaseMetric
+from deepeval.metrics import GEval
 
 load_dotenv()
 
@@ -27,30 +31,28 @@ SUPABASE_USER_PASSWORD = os.getenv("SUPABASE_USER_PASSWORD")
 EDGE_FUNCTION_URL = f"{SUPABASE_URL}/functions/v1/generate-quiz"
 DATASET_PATH = "articles.json"
 STATE_FILE = "quiz_run_state.json"
+STATE_SAVE_INTERVAL = 2.0  # Minimum seconds between debounced state saves
+FETCH_PAGE_SIZE = 1000      # Rows per page when downloading quizzes
+EVAL_CHUNK_SIZE = 50        # Test cases per evaluate() call; state is saved after each
+
+# Poll backoff (seconds): start short, double each time, cap at the max
+POLL_INITIAL_DELAY = 0.2
+POLL_MAX_DELAY = 5.0
+
+# Shared client so that triggers and polls reuse pooled (HTTP/2) connections
+_HTTP_CLIENT = httpx.AsyncClient(
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=15.0),
+    timeout=httpx.Timeout(60.0),
+    http2=True,
+    headers={"Content-Type": "application/json"},
+)
 
 # --- Metrics ---
-class SubstringMatchMetric(BaseMetric):
-    def __init__(self, threshold: float = 0.5):
-        self.threshold = threshold
-        self.score = 0
-        self.reason = ""
-
-    def measure(self, test_case: LLMTestCase):
-        question = test_case.input
-        answer = test_case.actual_output
-        self.score = 1.0 if answer.lower() in question.lower() else 0.0
-        self.success = self.score >= self.threshold
-        return self.score
-
-    async def a_measure(self, test_case: LLMTestCase):
-        return self.measure(test_case)
+# The substring check is computed in-process; only GEval goes through DeepEval.
+SUBSTRING_METRIC_NAME = "Answer-in-Question Substring Match"
 
-    def is_successful(self):
-        return self.success
-
-    @property
-    def __name__(self):
-        return "Answer-in-Question Substring Match"
+def substring_score(question: str, answer: str) -> float:
+    return 1.0 if answer.lower() in question.lower() else 0.0
 
 llm_model = GPTModel(
     model=os.environ.get('OPENAI_API_MODEL', 'gpt-4'),
@@ -75,13 +77,56 @@ naturalness_metric = GEval(
 
 def load_state() -> Dict[str, Any]:
     if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, "r") as f:
-            return json.load(f)
+        with open(STATE_FILE, "rb") as f:
+            return orjson.loads(f.read())
     return None
 
-def save_state(state: Dict[str, Any]):
-    with open(STATE_FILE, "w") as f:
-        json.dump(state, f, indent=2)
+# Debounce bookkeeping for save_state: time of the last write, and a state
+# whose write was skipped and still needs flushing at exit.
+_last_save = [0.0]
+_unsaved_state = [None]
+
+def _claim_save(state: Dict[str, Any], debounce: bool) -> bool:
+    """
+    Returns False if a debounced save should be skipped (remembering the state
+    for the exit flush), otherwise records the save and returns True.
+    """
+    if debounce and time.monotonic() - _last_save[0] < STATE_SAVE_INTERVAL:
+        _unsaved_state[0] = state
+        return False
+    _last_save[0] = time.monotonic()
+    _unsaved_state[0] = None
+    return True
+
+def _write_state_bytes(data: bytes):
+    tmp = STATE_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, STATE_FILE)
+
+def save_state(state: Dict[str, Any], debounce: bool = False):
+    """
+    Atomically write the state file. With debounce=True the write is skipped
+    if the last one was less than STATE_SAVE_INTERVAL seconds ago; skipped
+    state is flushed at exit.
+    """
+    if _claim_save(state, debounce):
+        _write_state_bytes(orjson.dumps(state, option=orjson.OPT_INDENT_2))
+
+async def save_state_async(state: Dict[str, Any], debounce: bool = False):
+    """
+    Like save_state, but the file is written in a worker thread so the event
+    loop is not blocked. Serializing happens first, on the loop, so later
+    changes to `state` cannot leak into the write.
+    """
+    if _claim_save(state, debounce):
+        data = orjson.dumps(state, option=orjson.OPT_INDENT_2)
+        await asyncio.get_running_loop().run_in_executor(None, _write_state_bytes, data)
+
+@atexit.register
+def _flush_state():
+    if _unsaved_state[0] is not None:
+        save_state(_unsaved_state[0])
 
 def get_authenticated_supabase() -> Client:
     """Creates a client and logs in the user immediately."""
@@ -94,6 +139,86 @@ def get_authenticated_supabase() -> Client:
 
 # --- Commands ---
 
+async def _trigger_task(task, client, headers, state):
+    """Trigger generation for one article+wordlist and return its thread id."""
+    payload = {
+        "new_quiz": {
+            "article_title": task['article']['title'],
+            "article_text": task['article']['text'],
+            "article_url": task['article']['url'],
+            "word_list_ids": [task['w_list']],
+            "meta": {
+                "is_test": True,
+                "run_id": state['run_id'],
+                "run_name": state['run_name']
+            }
+        }
+    }
+
+    resp = await client.post(EDGE_FUNCTION_URL, json=payload, headers=headers)
+    resp.raise_for_status()
+
+    # A new_quiz request answers with exactly one {thread_id: {status...}} entry
+    [(thread_id, values)] = resp.json().items()
+    return thread_id, values
+
+async def _poll_threads(client, headers, pending):
+    """
+    Polls every outstanding thread in a single request per tick, resolving each
+    thread's future in `pending` once it reports completed. Runs until cancelled.
+    """
+    delay = POLL_INITIAL_DELAY
+    while True:
+        await asyncio.sleep(delay)
+        if not pending:
+            delay = POLL_INITIAL_DELAY
+            continue
+
+        # The edge function accepts several thread ids in one body
+        try:
+            poll_resp = await client.post(
+                EDGE_FUNCTION_URL, json={tid: 'poll' for tid in pending}, headers=headers)
+            poll_resp.raise_for_status()
+            done = [tid for tid, values in poll_resp.json().items()
+                    if values.get('status') == 'completed' and tid in pending]
+        except (httpx.HTTPError, ValueError) as e:
+            # A failed poll only delays the threads; try again after backing off
+            print(f"Error while polling: {e}")
+            done = []
+        for tid in done:
+            pending.pop(tid).set_result(None)
+
+        # Back off while nothing finishes
+        delay = POLL_INITIAL_DELAY if done else min(delay * 2, POLL_MAX_DELAY)
+
+async def _run_task(task, sem, client, headers, state, lock, pending, progress=None):
+    """
+    Trigger generation for one article+wordlist and wait until it completes.
+    Errors are reported and contained, so one failed quiz never cancels the
+    others; the task is then left untriggered and retried on the next run.
+    Returns whether the quiz was generated.
+    """
+    async with sem:
+        try:
+            thread_id, values = await _trigger_task(task, client, headers, state)
+        except Exception as e:
+            print(f"Error during generation of {task['key']}: {e}")
+            return False
+
+        if values.get('status') != 'completed':
+            done = asyncio.get_running_loop().create_future()
+            pending[thread_id] = done
+            await done
+
+    async with lock:
+        # Mark as triggered in state so we don't repeat if script crashes
+        state['triggered_keys'].append(task['key'])
+        await save_state_async(state, debounce=True)
+
+    if progress is not None:
+        progress.update(1)
+    return True
+
 async def cmd_generate(args):
     """
     1. Triggers generation for all Article+WordList combinations.
@@ -127,120 +252,104 @@ async def cmd_generate(args):
 
     word_lists = getattr(args, 'word_lists', None) or ['default']
 
-    response = sb_client.table('word_lists').select('id, name').execute()
-    word_list_ids = []
-
-    for w in args.word_lists:
-        matches = [d['id'] for d in response.data if d['name'] == w]
-        word_list_ids += matches
+    # Let the database filter to the requested lists
+    response = sb_client.table('word_lists').select('id').in_('name', word_lists).execute()
+    word_list_ids = [d['id'] for d in response.data]
 
     assert word_list_ids, "Need at least one word list."
 
     # Build list of tasks
-    tasks = []
-    for article in articles:
-        for w_list in word_list_ids:
-            key = f"{article['url']}::{w_list}"
-            if key not in state['triggered_keys']:
-                tasks.append({
-                    "key": key,
-                    "article": article,
-                    "w_list": w_list
-                })
+    triggered_set = set(state['triggered_keys'])
+    tasks = [
+        {"key": key, "article": article, "w_list": w_list}
+        for article, w_list in itertools.product(articles, word_list_ids)
+        if (key := f"{article['url']}::{w_list}") not in triggered_set
+    ]
 
     if tasks:
         print(f"Generating {len(tasks)} missing quizzes...")
-        client = httpx.AsyncClient(timeout=60.0)
-        headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-
-        try:
-            for task in tqdm(tasks, desc="Triggering"):
-                payload = {
-                    "new_quiz": {
-                        "article_title": task['article']['title'],
-                        "article_text": task['article']['text'],
-                        "article_url": task['article']['url'],
-                        "word_list_ids": [task['w_list']],
-                        "meta": {
-                            "is_test": True,
-                            "run_id": state['run_id'],
-                            "run_name": state['run_name']
-                        }
-                    }
-                }
-
-                # Trigger
-                resp = await client.post(EDGE_FUNCTION_URL, json=payload, headers=headers)
-                resp.raise_for_status()
+        client = _HTTP_CLIENT
+        headers = {"Authorization": f"Bearer {access_token}"}
 
-                # Poll
-                data = resp.json()
-                thread_id, values = next(iter(data.items()))
+        # Limit the number of in-flight quizzes; the lock serializes state saves
+        sem = asyncio.Semaphore(args.concurrency)
+        lock = asyncio.Lock()
+        pending = {}  # thread_id -> future resolved by the poller
+        progress = tqdm(total=len(tasks), desc="Triggering")
 
-                while values.get('status') != 'completed':
-                    await asyncio.sleep(1)
-                    poll_resp = await client.post(EDGE_FUNCTION_URL, json={thread_id: 'poll'}, headers=headers)
-                    data = poll_resp.json()
-                    thread_id, values = next(iter(data.items()))
-
-                # Mark as triggered in state so we don't repeat if script crashes
-                state['triggered_keys'].append(task['key'])
-                # We save frequently to support re-entrancy
-                save_state(state)
-
-        except Exception as e:
-            print(f"Error during generation: {e}")
-            raise e
+        try:
+            # Each quiz frees its slot as soon as it completes, so a slow quiz
+            # never holds back the others. _run_task contains its own errors, so
+            # a failed quiz does not cancel the group; once every run is done the
+            # poller is stopped and retrieval below still goes ahead.
+            async with asyncio.TaskGroup() as tg:
+                poller = tg.create_task(_poll_threads(client, headers, pending))
+                runs = [tg.create_task(_run_task(t, sem, client, headers, state, lock, pending, progress))
+                        for t in tasks]
+                await asyncio.wait(runs)
+                poller.cancel()
         finally:
+            progress.close()
             await client.aclose()
+
+        failed = sum(not r.result() for r in runs)
+        if failed:
+            print(f"{failed} of {len(tasks)} quizzes failed to generate; run generate again to retry them.")
     else:
         print("All combinations have been triggered already.")
 
     # --- Retrieval Phase ---
     print("Fetching all quizzes from database...")
 
-    # Fetch everything for this run
-    response = sb_client.table("quizzes") \
-        .select("*") \
-        .eq("context->meta->>run_id", state['run_id']) \
-        .execute()
-
-    db_rows = response.data
-    print(f"Downloaded {len(db_rows)} quizzes.")
-
     # We overwrite the local cache with the authoritative DB state
-    # We clean/flatten the data slightly for the evaluator
+    # We clean/flatten the data slightly for the evaluator, one page at a time
     clean_quizzes = []
-    for row in db_rows:
-        ctx = row.get('context', {})
-
-        clean_quizzes.append({
-            "supabase_id": row['id'],
-            "article_title": ctx.get('article_title', 'Unknown'),
-            "article_url": ctx.get('article_url', ''),
-            "word_list": ctx.get('word_list', 'default'),
-            "quiz_content": row.get('content', []), # List of Q/A pairs
-            "eval_results": None # Placeholder
-        })
+    offset = 0
+    while True:
+        response = sb_client.table("quizzes") \
+            .select("id, context, content") \
+            .eq("context->meta->>run_id", state['run_id']) \
+            .order("id") \
+            .range(offset, offset + FETCH_PAGE_SIZE - 1) \
+            .execute()
+
+        if not response.data:
+            break
+
+        for row in response.data:
+            ctx = row.get('context', {})
+
+            clean_quizzes.append({
+                "supabase_id": row['id'],
+                "article_title": ctx.get('article_title', 'Unknown'),
+                "article_url": ctx.get('article_url', ''),
+                "word_list": ctx.get('word_list', 'default'),
+                "quiz_content": row.get('content', []), # List of Q/A pairs
+                "eval_results": None # Placeholder
+            })
+
+        if len(response.data) < FETCH_PAGE_SIZE:
+            break
+        offset += FETCH_PAGE_SIZE
+
+    print(f"Downloaded {len(clean_quizzes)} quizzes.")
 
     state['quizzes'] = clean_quizzes
     save_state(state)
     print("State updated. Ready for evaluation.")
 
-def cmd_evaluate(args):
-    state = load_state()
-    if not state:
-        print("No state file found. Run 'generate' first.")
-        return
+def _build_test_cases(quizzes):
+    """
+    Builds test cases for every question that has no eval result yet.
 
-    quizzes = state.get('quizzes', [])
+    Returns (test_cases, map_back, sub_scores), where map_back holds
+    (quiz_index_in_state, question_index_inside_quiz) and sub_scores holds the
+    substring match score, both parallel to test_cases.
+    """
     test_cases = []
-
-    # Map back structure: (quiz_index_in_state, question_index_inside_quiz)
     map_back = []
+    sub_scores = []
 
-    # 1. Build Test Cases
-    count_new = 0
     for q_idx, quiz in enumerate(quizzes):
         questions = quiz.get('quiz_content', [])
 
@@ -254,82 +363,28 @@ def cmd_evaluate(args):
         for i, q_item in enumerate(questions):
             # Only add if result is missing
             if quiz['eval_results'][i] is None:
+                question = q_item.get("question", "")
+                answer = q_item.get("answer", "")
                 test_case = LLMTestCase(
-                    input=q_item.get("question", ""),
-                    actual_output=q_item.get("answer", ""),
-                    retrieval_context=[quiz.get('source_text', "")]
+                    input=question,
+                    actual_output=answer,
+                    retrieval_context=[quiz.get('source_text', "")],
                 )
                 test_cases.append(test_case)
+                sub_scores.append(substring_score(question, answer))
                 map_back.append((q_idx, i))
-                count_new += 1
-
-    if count_new == 0:
-        print("All questions have been evaluated.")
-        return
-
-    print(f"Evaluating {count_new} questions...")
-
-    # 2. Run Evaluation
-    metrics = [SubstringMatchMetric(), naturalness_metric]
-
-    try:
-        results = evaluate(
-            test_cases,
-            metrics,
-            display_config=DisplayConfig(print_results=False),
-            async_config=AsyncConfig(max_concurrent=args.concurrency),
-        )
 
-        # 3. Save Results
-        for idx, result in enumerate(results.test_results):
-            q_idx, i_idx = map_back[idx]
+    return test_cases, map_back, sub_scores
 
-            scores = {m.name: m.score for m in result.metrics_data}
-
-            # Update state
-            state['quizzes'][q_idx]['eval_results'][i_idx] = scores
-
-    except Exception as e:
-        print(f"Error during evaluation: {e}")
-    finally:
-        save_state(state)
-        print("Progress saved.")
-
-# Batch version, but let's see if there's a config option we can use above?
 def cmd_evaluate(args):
     state = load_state()
     if not state:
         print("No state file found. Run 'generate' first.")
         return
 
-    quizzes = state.get('quizzes', [])
-    test_cases = []
-
-    # Map back structure: (quiz_index_in_state, question_index_inside_quiz)
-    map_back = []
-
     # 1. Build Test Cases
-    count_new = 0
-    for q_idx, quiz in enumerate(quizzes):
-        questions = quiz.get('quiz_content', [])
-
-        # Ensure eval_results list exists and is correct length
-        if not quiz.get('eval_results'):
-            quiz['eval_results'] = [None] * len(questions)
-        elif len(quiz['eval_results']) != len(questions):
-            quiz['eval_results'] = [None] * len(questions)
-
-        for i, q_item in enumerate(questions):
-            # Only add if result is missing
-            if quiz['eval_results'][i] is None:
-                test_case = LLMTestCase(
-                    input=q_item.get("question", ""),
-                    actual_output=q_item.get("answer", ""),
-                    retrieval_context=[quiz.get('source_text', "")]
-                )
-                test_cases.append(test_case)
-                map_back.append((q_idx, i))
-                count_new += 1
+    test_cases, map_back, sub_scores = _build_test_cases(state.get('quizzes', []))
+    count_new = len(test_cases)
 
     if count_new == 0:
         print("All questions have been evaluated.")
@@ -337,53 +392,48 @@ def cmd_evaluate(args):
 
     print(f"Evaluating {count_new} questions...")
 
-    metrics = [SubstringMatchMetric(), naturalness_metric]
-
-    # 2. Run Evaluation in Batches
-    # We process in small chunks so that if a crash occurs,
-    # we don't lose the progress of the whole run.
-    BATCH_SIZE = 10
-
-    # Calculate total batches for progress bar
-    total_batches = (len(test_cases) + BATCH_SIZE - 1) // BATCH_SIZE
+    metrics = [naturalness_metric]
 
+    # 2. Run Evaluation
+    # Each evaluate() call keeps up to args.concurrency cases in flight. Chunks
+    # are large enough to keep DeepEval busy, and the state is saved after each
+    # one, so if we crash, running 'evaluate' again only redoes the current
+    # chunk (and DeepEval's cache skips cases it already scored).
     try:
-        for i in range(0, len(test_cases), BATCH_SIZE):
-            current_batch_cases = test_cases[i : i + BATCH_SIZE]
-            current_batch_map = map_back[i : i + BATCH_SIZE]
-
-            print(f"Processing batch {i // BATCH_SIZE + 1}/{total_batches} ({len(current_batch_cases)} items)...")
-
-            try:
-                # Run DeepEval on just this chunk
-                results = evaluate(
-                    current_batch_cases,
-                    metrics,
-                    display_config=DisplayConfig(print_results=False),
-                    async_config=AsyncConfig(max_concurrent=args.concurrency),
-                )
-
-                # Update state immediately for this batch
-                for idx, result in enumerate(results.test_results):
-                    q_idx, i_idx = current_batch_map[idx]
-
-                    scores = {m.name: m.score for m in result.metrics_data}
-                    state['quizzes'][q_idx]['eval_results'][i_idx] = scores
-
-                # Save after every successful batch
-                save_state(state)
-
-            except Exception as batch_error:
-                print(f"Error in batch {i // BATCH_SIZE + 1}: {batch_error}")
-                print("Saving progress and stopping. Run 'evaluate' again to resume.")
-                # We re-raise to exit the loop, or you could 'continue' to skip bad batches
-                # But typically 'invalid json' might persist if not handled.
-                raise batch_error
+        for start in range(0, count_new, EVAL_CHUNK_SIZE):
+            chunk = range(start, min(start + EVAL_CHUNK_SIZE, count_new))
+            results = evaluate(
+                [test_cases[idx] for idx in chunk],
+                metrics,
+                display_config=DisplayConfig(print_results=False),
+                async_config=AsyncConfig(max_concurrent=args.concurrency),
+                cache_config=CacheConfig(write_cache=True, use_cache=True),
+            )
+
+            # 3. Save Results
+            # Results are not guaranteed to come back in input order, so match
+            # them to their test case by content
+            by_case = {}
+            for idx in chunk:
+                by_case.setdefault((test_cases[idx].input, test_cases[idx].actual_output), []).append(idx)
+
+            for result in results.test_results:
+                idx = by_case[(result.input, result.actual_output)].pop()
+                q_idx, i_idx = map_back[idx]
+
+                scores = {SUBSTRING_METRIC_NAME: sub_scores[idx],
+                          **{m.name: m.score for m in result.metrics_data}}
+
+                # Update state
+                state['quizzes'][q_idx]['eval_results'][i_idx] = scores
+
+            save_state(state)
+            print(f"Evaluated {chunk.stop}/{count_new} questions.")
 
     except Exception as e:
         print(f"\nStopped due to error: {e}")
+        print("Run 'evaluate' again to resume.")
     finally:
-        # Final save just in case
         save_state(state)
         print("Progress saved.")
 
@@ -417,8 +467,8 @@ def cmd_report(args):
 
     print("\n--- Summary by Metric ---")
     metric_cols = [col for col in df.columns if col not in ['article', 'word_list']]
-    melted = df.melt(id_vars=['article'], value_vars=metric_cols, var_name='metric', value_name='score')
-    print(melted.groupby('metric')['score'].describe())
+    # One row per metric, like the describe() of the per-metric groups
+    print(df[metric_cols].describe().T)
 
     if 'word_list' in df.columns:
         print("\n--- Summary by Word List ---")
@@ -460,10 +510,11 @@ def main():
     gen = subparsers.add_parser("generate")
     gen.add_argument("--run-name", type=str, required=True)
     gen.add_argument("--word-lists", nargs='+', default=["default"])
+    gen.add_argument("--concurrency", type=int, default=10)
 
     # Evaluate
     evl = subparsers.add_parser("evaluate")
-    evl.add_argument("--concurrency", type=int, default=2)
+    evl.add_argument("--concurrency", type=int, default=10)
 
     # Report
     rep = subparsers.add_parser("report")
@@ -1,31 +1,62 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
-
-class RequestHandler(BaseHTTPRequestHandler):
-    def do_POST(self):
-        content_length = int(self.headers['Content-Length'])
-        body = self.rfile.read(content_length)
-        print("Received request headers:")
-        print(self.headers)
-        print("Received request body:")
-        print(body.decode('utf-8'))
-
-        # Respond with a status code 200
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b'Request body received')
-
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b'GET request received, but no body is available.')
-
-def run(server_class=HTTPServer, handler_class=RequestHandler, port=9000):
-    server_address = ('', port)
-    httpd = server_class(server_address, handler_class)
+# /// script
+# requires-python = ">=3.10"
+# dependencies = [
+#     "starlette",
+#     "uvicorn",
+# ]
+# ///
+import logging
+import logging.handlers
+import queue
+from contextlib import asynccontextmanager
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+# Log through a queue so that writing to stdout happens on the listener
+# thread, not in the request handler.
+log_queue = queue.Queue(-1)
+listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+log = logging.getLogger('webhook')
+log.setLevel(logging.INFO)
+log.addHandler(logging.handlers.QueueHandler(log_queue))
+
+def log_request(headers, body: bytes):
+    log.info("Received request headers:\n%s", headers)
+    log.info("Received request body:\n%s", body.decode('utf-8'))
+
+async def post_handler(request: Request):
+    body = await request.body()
+
+    # Respond with a status code 200; the body is logged after the response is sent
+    return PlainTextResponse('Request body received',
+                             background=BackgroundTask(log_request, request.headers, body))
+
+async def get_handler(request: Request):
+    return PlainTextResponse('GET request received, but no body is available.')
+
+@asynccontextmanager
+async def lifespan(app):
+    # Start the listener with the app, however it is served
+    listener.start()
+    try:
+        yield
+    finally:
+        listener.stop()
+
+app = Starlette(lifespan=lifespan, routes=[
+    Route('/', post_handler, methods=['POST']),
+    Route('/', get_handler, methods=['GET']),
+])
+
+def run(port=9000):
     print(f'Serving on port {port}...')
-    httpd.serve_forever()
+    # loop="auto" picks uvloop when it is installed
+    uvicorn.run(app, host='0.0.0.0', port=port, loop='auto')
 
 if __name__ == "__main__":
     run()